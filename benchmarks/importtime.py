@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Measures import cost of every tgmount.py command with `python -X importtime`.
+
+The commands that talk to telegram can't be run without credentials so for them
+the modules imported on their path before any network activity are imported instead.
+
+    $ python benchmarks/importtime.py [--runs N] [--top N]
+"""
+
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser
+from statistics import median
+
+SCRIPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tgmount')
+
+# imported by tgmount.py itself before dispatching a command
+ENTRY_POINT = ['tgmount.layouts', 'tgmount.logging', 'tgmount.util']
+
+# the modules each command path imports, keep in sync with tgmount.py and tgmount/actions.py
+COMMANDS = {
+    'list-dialogs': ENTRY_POINT + ['tgmount.tgclient', 'tgmount.actions'],
+    'list-documents': ENTRY_POINT + ['tgmount.tgclient', 'tgmount.actions'],
+    'download': ENTRY_POINT + ['tgmount.tgclient', 'tgmount.actions', 'tqdm'],
+    'mount': ENTRY_POINT + ['tgmount.tgclient', 'tgmount.actions', 'pyfuse3', 'pyfuse3_asyncio', 'tgmount.tgvfs'],
+}
+
+
+def parse_importtime(stderr: str):
+    """
+    Returns list of tuples (module, self_us, cumulative_us, nesting level)
+    """
+    result = []
+
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        [self_us, cumulative_us, name] = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip())) // 2
+
+        result.append((name.strip(), int(self_us), int(cumulative_us), level))
+
+    return result
+
+
+def run(args):
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                          cwd=SCRIPT_DIR, capture_output=True, text=True)
+
+    if proc.returncode != 0 and 'ModuleNotFoundError' in proc.stderr:
+        raise ModuleNotFoundError(proc.stderr.strip().splitlines()[-1])
+
+    return parse_importtime(proc.stderr)
+
+
+def command_args(command: str):
+    if command == 'help':
+        return ['tgmount.py', '--help']
+
+    return ['-c', '; '.join('import %s' % module for module in COMMANDS[command])]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help='runs per command. Default: 5')
+    parser.add_argument('--top', type=int, default=5, help='print N most expensive top level imports. Default: 5')
+    options = parser.parse_args()
+
+    for command in ['help'] + list(COMMANDS.keys()):
+        try:
+            runs = [run(command_args(command)) for _ in range(options.runs)]
+        except ModuleNotFoundError as e:
+            print("%-16s skipped: %s" % (command, e))
+            continue
+
+        totals = [sum(self_us for _, self_us, _, _ in imports) for imports in runs]
+
+        print("%-16s %8.1f ms  %4d modules" % (command, median(totals) / 1000, len(runs[-1])))
+
+        top_level = sorted((i for i in runs[-1] if i[3] == 0), key=lambda i: i[2], reverse=True)
+
+        for name, _, cumulative_us, _ in top_level[:options.top]:
+            print("    %-30s %8.1f ms" % (name, cumulative_us / 1000))
+
+
+if __name__ == '__main__':
+    main()
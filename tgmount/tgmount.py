@@ -7,11 +7,9 @@ import sys
 import traceback
 from argparse import ArgumentParser
 
-import pyfuse3
-
-from tgmount.actions import download, list_dialogs, list_documents, mount
+# telethon, pyfuse3 and the rest of the heavy modules are imported by the commands that use them
+from tgmount.layouts import LAYOUTS
 from tgmount.logging import init_logging
-from tgmount.tgclient import TelegramFsClient
 from tgmount.util import (int_or_string, none_or_int, proxy_arg)
 
 unmount_required = False
@@ -20,6 +18,15 @@ unmount_required = False
 async def main():
     global unmount_required
 
+    [args_parser, options] = parse_args()
+
+    if not (options.list_dialogs or options.list_documents or options.mount or options.download):
+        args_parser.print_help()
+        return
+
+    if options.id and len(options.id) > 1 and not options.mount:
+        args_parser.error('multiple --id are only supported with --mount')
+
     api_id = None
     api_hash = None
 
@@ -36,8 +43,6 @@ async def main():
         print("Obtain your API credentials at https://my.telegram.org/apps")
         sys.exit(1)
 
-    [args_parser, options] = parse_args()
-
     init_logging(options.debug)
 
     logging.debug(options)
@@ -45,29 +50,37 @@ async def main():
     proxy = options.socks
 
     async def client():
+        from tgmount.tgclient import TelegramFsClient
+
         client = TelegramFsClient(options.session, api_id, api_hash, proxy, options.ipv6)
         await client.auth()
         return client
 
     if options.list_dialogs:
+        from tgmount.actions import list_dialogs
+
         await list_dialogs(await client(),
                            limit=none_or_int(options.limit),
-                           json_output=options.json,
+                           output_format=output_format(options),
                            offset_id=int_or_string(options.offset_id))
 
     elif options.list_documents:
+        from tgmount.actions import list_documents
+
         await list_documents(await client(),
-                             id=int_or_string(options.id),
+                             id=int_or_string(options.id[0]),
                              offset_id=int(options.offset_id),
                              limit=none_or_int(options.limit),
                              reverse=options.reverse,
-                             json_output=options.json,
+                             output_format=output_format(options),
                              filter_music=not options.all_files)
 
     elif options.mount:
+        from tgmount.actions import mount
+
         unmount_required = True
         await mount(await client(),
-                    id=int_or_string(options.id),
+                    ids=[int_or_string(id) for id in options.id],
                     destination=options.mount,
                     offset_id=int(options.offset_id),
                     limit=none_or_int(options.limit),
@@ -75,15 +88,28 @@ async def main():
                     debug_fuse=options.debug_fuse,
                     reverse=options.reverse,
                     updates=not options.no_updates,
-                    fsname=options.fsname)
+                    fsname=options.fsname,
+                    id3_tags=options.id3_tags,
+                    layout=options.layout,
+                    search=options.search,
+                    cache_dir=options.cache_dir)
 
     elif options.download:
+        from tgmount.actions import download
+
         await download(await client(),
-                       id=int_or_string(options.id),
+                       id=int_or_string(options.id[0]),
                        destination=options.download,
                        files=[int(id) for id in options.files.split(',')])
+
+
+def output_format(options):
+    if options.ndjson:
+        return 'ndjson'
+    elif options.json:
+        return 'json'
     else:
-        args_parser.print_help()
+        return 'tsv'
 
 
 def parse_args():
@@ -91,11 +117,12 @@ def parse_args():
 
     parser = ArgumentParser()
 
-    parser.add_argument('--id', default=None,
+    parser.add_argument('--id', default=None, action='append',
                         required='--mount' in sys.argv
                                  or '--list-documents' in sys.argv
                                  or '--download' in sys.argv,
-                        help='chat or channel ID. Telegram username or numeric ID')
+                        help='chat or channel ID. Telegram username or numeric ID. '
+                             'Repeat to mount several chats as subdirectories')
 
     #  actions
     parser.add_argument('--mount', type=str, metavar='DIR',
@@ -123,6 +150,21 @@ def parse_args():
     parser.add_argument('--no-updates', action='store_true', default=False,
                         help='don\'t listen for new files. Default: no')
 
+    parser.add_argument('--id3-tags', action='store_true', default=False,
+                        help='prepend ID3 tag built from telegram metadata to mp3 files '
+                             'so players can index them without downloading. Default: no')
+
+    parser.add_argument('--layout', default='flat', choices=list(LAYOUTS.keys()),
+                        help='directory structure of the mount: flat, performer, date (year/month) '
+                             'or mime (type/subtype). Default: flat')
+
+    parser.add_argument('--search', action='store_true', default=False,
+                        help='index documents and list the ones matching QUERY in /.search/QUERY/. Default: no')
+
+    parser.add_argument('--cache-dir', type=str, default=None, metavar='DIR',
+                        help='keep downloaded blocks in DIR. The directory can be shared by several '
+                             'tgmount processes. Default: no cache')
+
     parser.add_argument('--reverse', action='store_true', default=False,
                         help='documents will be searched in reverse order (from oldest to newest). Default: from newest to oldest')
 
@@ -158,6 +200,9 @@ def parse_args():
     parser.add_argument('--json', action='store_true', default=False,
                         help='json output. Default: no')
 
+    parser.add_argument('--ndjson', action='store_true', default=False,
+                        help='newline delimited json output, one object per line. Default: no')
+
     return [parser, parser.parse_args()]
 
 
@@ -172,4 +217,6 @@ if __name__ == '__main__':
         print(traceback.format_exc())
     finally:
         if unmount_required:
+            import pyfuse3
+
             pyfuse3.close(unmount=True)
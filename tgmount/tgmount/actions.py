@@ -1,103 +1,168 @@
+import asyncio
 import dataclasses
-import json
 import logging
 from typing import List
 
-import pyfuse3
-import pyfuse3_asyncio
 from telethon.hints import Entity
 from telethon.tl import types
 from telethon.utils import get_display_name
-from tqdm import tqdm
 
-from .tgclient import TelegramFsClient
-from .tgvfs import TelegramFsAsync
-from .util import DateTimeEncoder
+from .dclasses import MountedChat
+from .layouts import LAYOUTS, path_component
+from .tgclient import TelegramFsClient, is_music
+from .util import print_records
 
 
-async def list_dialogs(client: TelegramFsClient, limit=None, json_output=False, offset_id=0):
-    dialogs = await client.get_dialogs_dict(limit=limit, offset_id=offset_id)
+async def list_dialogs(client: TelegramFsClient, limit=None, output_format='tsv', offset_id=0):
+    dialogs = client.iter_dialogs(limit=limit, offset_id=offset_id)
 
-    result = [{
-        'name': name,
-        'id': dialog.id,
-    } for name, dialog in dialogs.items()]
-
-    if json_output:
-        print(json.dumps(result))
-    else:
-        for d in result:
-            print("%s\t%s" % (d['id'], d['name']))
+    await print_records(({'name': get_display_name(dialog.entity), 'id': dialog.entity.id}
+                         async for dialog in dialogs),
+                        output_format,
+                        lambda d: "%s\t%s" % (d['id'], d['name']))
 
 
 async def list_documents(client, id, offset_id: int = 0, limit: int = None,
-                         filter_music=False, reverse=False, json_output=False):
+                         filter_music=False, reverse=False, output_format='tsv'):
     logging.debug("list_documents(id=%s, offset_id=%s, limit=%s)" %
                   (id, offset_id, limit))
     logging.debug("Querying entity %s(%s)" % (type(id), id))
 
-    entity = await client.get_entity(id)
+    entity = await client.resolve_entity(id)
 
     logging.debug("Querying documents")
 
-    messages, documents_handles = await client.get_documents(entity,
-                                                             limit=limit,
-                                                             offset_id=offset_id,
-                                                             filter_music=filter_music,
-                                                             reverse=reverse)
+    documents = client.iter_documents(entity,
+                                      limit=limit,
+                                      offset_id=offset_id,
+                                      filter_music=filter_music,
+                                      reverse=reverse)
+
+    await print_records((dataclasses.asdict(dh.document) async for msg, dh in documents),
+                        output_format,
+                        lambda d: "%s\t%s" % (d['message_id'], d['attributes']['file_name']))
+
+
+def create_gap_recovery(client: TelegramFsClient, telegram_fs, chats: List[MountedChat], filter_music=False):
+    """
+    Returns coroutine function fetching messages posted while updates weren't being received
+    """
+    lock = asyncio.Lock()
+
+    async def recover_gap():
+        async with lock:
+            for chat in chats:
+                logging.debug("Fetching messages newer than %d from '%s'" %
+                              (chat.last_message_id, get_display_name(chat.entity)))
+
+                messages, documents_handles = [], []
+                last_message_id = chat.last_message_id
+
+                async for msg in client.iter_messages(chat.entity,
+                                                      min_id=chat.last_message_id,
+                                                      reverse=True,
+                                                      filter=types.InputMessagesFilterMusic if filter_music else None):
+                    # messages without documents count too, otherwise they'd be fetched on every reconnect
+                    last_message_id = max(last_message_id, msg.id)
+                    document_handle = client.get_document_handle(msg)
+
+                    if document_handle:
+                        messages.append(msg)
+                        documents_handles.append(document_handle)
+
+                if messages:
+                    logging.info("Recovered %d files from '%s'" %
+                                 (len(documents_handles), get_display_name(chat.entity)))
 
-    result = [dataclasses.asdict(dh.document) for dh in documents_handles]
+                chat.last_message_id = last_message_id
 
-    if json_output:
-        print(json.dumps(result, cls=DateTimeEncoder))
-    else:
-        for d in result:
-            print("%s\t%s" % (d['message_id'], d['attributes']['file_name']))
+                telegram_fs.add_files(messages, documents_handles, chat.inode)
 
+    return recover_gap
 
-def create_new_files_handler(client: TelegramFsClient, telegram_fs, entity: Entity):
-    async def new_files_handler(update):
-        if not isinstance(update, (types.UpdateNewMessage, types.UpdateNewChannelMessage)):
-            # logging.debug("Not instance UpdateNewMessage or UpdateNewChannelMessage")
-            return
 
-        if isinstance(update, types.UpdateNewChannelMessage):
-            if not update.message.to_id:
+def create_updates_handler(client: TelegramFsClient, telegram_fs, chat: MountedChat, filter_music=False):
+    """
+    Keeps the chat's files in sync with new, edited and deleted messages
+    """
+    chat_id = chat.chat_id
+    is_channel = isinstance(chat.entity, types.Channel)
+
+    def remove_files(message_ids: List[int]):
+        for message_id in message_ids:
+            if telegram_fs.remove_file(chat_id, message_id):
+                logging.debug(f'removed file: msg={message_id} chat={chat_id}')
+
+    async def updates_handler(update):
+        if isinstance(update, types.UpdateDeleteChannelMessages):
+            if not is_channel or update.channel_id != chat.entity.id:
                 return
-            update_entity_id = update.message.to_id.channel_id
-            if update_entity_id != entity.id:
-                # logging.debug("Not required channel id %d != %d" % (update_entity_id, entity.id))
+
+            remove_files(update.messages)
+
+        elif isinstance(update, types.UpdateDeleteMessages):
+            # message ids outside of channels are unique per account so the update carries no chat
+            if is_channel:
                 return
 
-        elif isinstance(update, types.UpdateNewMessage):
-            update_entity_id = update.message.chat_id
-            if update_entity_id != entity.id:
-                # logging.debug("Not required chat id %d != %d" % (update_entity_id, entity.id))
+            remove_files(update.messages)
+
+        elif isinstance(update, (types.UpdateNewMessage, types.UpdateNewChannelMessage)):
+            msg = update.message
+
+            if msg.chat_id != chat_id:
                 return
 
-        msg = update.message
+            chat.last_message_id = max(chat.last_message_id, msg.id)
 
-        if not getattr(msg, 'media', None):
-            return
+            if filter_music and not is_music(msg):
+                return
 
-        if not getattr(msg.media, 'document', None):
-            return
+            document_handle = client.get_document_handle(msg)
 
-        document_handle = client.get_document_handle(msg)
+            if not document_handle:
+                return
 
-        if not document_handle:
-            return
+            logging.debug(f'new msg: {msg}')
+            logging.debug(f'new file: {document_handle.document}')
 
-        logging.debug(f'new msg: {msg}')
-        logging.debug(f'new file: {document_handle.document}')
+            telegram_fs.add_file(msg, document_handle, chat.inode)
 
-        telegram_fs.add_file(msg, document_handle)
+        elif isinstance(update, (types.UpdateEditMessage, types.UpdateEditChannelMessage)):
+            msg = update.message
 
-    return new_files_handler
+            if msg.chat_id != chat_id:
+                return
+
+            logging.debug(f'edited msg: {msg}')
+
+            if filter_music and not is_music(msg):
+                document_handle = None
+            else:
+                document_handle = client.get_document_handle(msg)
+
+            telegram_fs.update_file(msg, document_handle, chat.inode)
+
+    return updates_handler
+
+
+async def mount(client, ids: List, destination: str, offset_id=0, limit=None,
+                filter_music=False, debug_fuse=False, reverse=False, updates=False, fsname="tgfs",
+                id3_tags=False, layout='flat', search=False, cache_dir=None):
+    """
+    Mounts documents from one or several chats. A single chat is mounted to the root of
+    destination, several chats are mounted as subdirectories named after the chats.
+    All the chats are served by the same client and the same FUSE session.
+    """
+    import pyfuse3
+    import pyfuse3_asyncio
+
+    from .cache import SharedBlockCache
+    from .tgvfs import TelegramFsAsync
 
+    if cache_dir:
+        client.block_cache = SharedBlockCache(cache_dir)
 
-async def mount(client, id, destination: str, offset_id=0, limit=None,
-                filter_music=False, debug_fuse=False, reverse=False, updates=False, fsname="tgfs"):
     pyfuse3_asyncio.enable()
     fuse_options = set(pyfuse3.default_options)
     fuse_options.add('fsname=' + fsname)
@@ -105,37 +170,61 @@ async def mount(client, id, destination: str, offset_id=0, limit=None,
     if debug_fuse:
         fuse_options.add('debug')
 
-    # in order to use numeric id
-    if isinstance(id, int):
-        await client.get_dialogs()
+    telegram_fs = TelegramFsAsync(id3_tags=id3_tags, layout=LAYOUTS[layout], search=search)
+    chats: List[MountedChat] = []
+    chat_names = set()
 
-    logging.debug("Querying entity %s" % id)
+    for id in ids:
+        logging.debug("Querying entity %s" % id)
 
-    entity: Entity = await client.get_entity(id)
+        entity: Entity = await client.resolve_entity(id)
 
-    logging.debug("Got '%s'" % get_display_name(entity))
+        logging.debug("Got '%s'" % get_display_name(entity))
 
-    logging.info("Querying %s messages starting with message_id %d, music: %s" %
-                 (limit if limit else "all", offset_id, filter_music))
+        if len(ids) > 1:
+            name = path_component(get_display_name(entity))
 
-    messages, documents_handles = await client.get_documents(entity,
-                                                             limit=limit,
-                                                             filter_music=filter_music,
-                                                             offset_id=offset_id,
-                                                             reverse=reverse)
+            if name in chat_names:
+                name += (" %d" % entity.id).encode()
 
-    logging.info("Mounting %d files to %s" % (len(documents_handles), destination))
-    # logging.debug("Files: %s" % ([doc['id'] for msg, doc in documents], ))
+            chat_names.add(name)
 
-    telegram_fs = TelegramFsAsync()
+            chat = MountedChat(entity, telegram_fs.mkdir(name))
+        else:
+            chat = MountedChat(entity, pyfuse3.ROOT_INODE)
 
-    for msg, dh in zip(messages, documents_handles):
-        telegram_fs.add_file(msg, dh)
+        if updates:
+            # taken before the scan so posts made while it runs are recovered after it
+            latest = await client.get_messages(entity, limit=1)
+            chat.last_message_id = latest[0].id if latest else 0
+
+        logging.info("Querying %s messages starting with message_id %d, music: %s" %
+                     (limit if limit else "all", offset_id, filter_music))
+
+        messages, documents_handles = await client.get_documents(entity,
+                                                                 limit=limit,
+                                                                 filter_music=filter_music,
+                                                                 offset_id=offset_id,
+                                                                 reverse=reverse)
+
+        logging.info("Mounting %d files from '%s' to %s" %
+                     (len(documents_handles), get_display_name(entity), destination))
+
+        telegram_fs.add_files(messages, documents_handles, chat.inode)
+
+        chats.append(chat)
 
     if updates:
-        client.add_event_handler(
-            create_new_files_handler(client, telegram_fs, entity),
-        )
+        recover_gap = create_gap_recovery(client, telegram_fs, chats, filter_music=filter_music)
+        client.add_reconnect_handler(recover_gap)
+
+        for chat in chats:
+            client.add_event_handler(
+                create_updates_handler(client, telegram_fs, chat, filter_music=filter_music),
+            )
+
+        # messages posted while the chats were being loaded
+        await recover_gap()
 
     pyfuse3.init(telegram_fs, destination, fuse_options)
 
@@ -143,12 +232,14 @@ async def mount(client, id, destination: str, offset_id=0, limit=None,
 
 
 async def download(client: TelegramFsClient, id, destination: str, files: List[int]):
+    from tqdm import tqdm
+
     logging.info("Download files %s from %s to %s" %
                  (files, id, destination))
 
     logging.debug("Querying entity %s(%s)" % (type(id), id))
 
-    entity = await client.get_entity(id)
+    entity = await client.resolve_entity(id)
 
     documents = await client.get_documents(entity, ids=files)
 
@@ -0,0 +1,129 @@
+import fcntl
+import logging
+import mmap
+import os
+from typing import Optional
+
+from tgmount.tgclient import BLOCK_SIZE
+
+logger = logging.getLogger('tgclient')
+
+
+class CachedDocument:
+    """
+    Blocks of a single document. <document_id>.data is a sparse file of the document's size and
+    <document_id>.map has a byte per block which is set once the block is written.
+
+    Writers hold an exclusive flock on the map file and flush blocks to disk before marking them,
+    so readers don't need a lock and a marked block is complete even after a crash. Reads are
+    served from mmap of the data file so the processes share the page cache instead of keeping
+    copies. The methods block on disk I/O and are meant to be called from an executor.
+    """
+
+    def __init__(self, path: str, document_id: str, size: int):
+        self.size = size
+        self.blocks = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+        self._data_path = os.path.join(path, "%s.data" % document_id)
+        self._map_path = os.path.join(path, "%s.map" % document_id)
+
+    def _has_blocks(self, first: int, last: int):
+        try:
+            fd = os.open(self._map_path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+
+        try:
+            marks = os.pread(fd, last - first + 1, first)
+        finally:
+            os.close(fd)
+
+        return len(marks) == last - first + 1 and marks.count(1) == len(marks)
+
+    def get(self, offset: int, limit: int) -> Optional[bytes]:
+        """
+        Returns the range if all the blocks covering it are cached
+        """
+        end = min(offset + limit, self.size)
+
+        if offset >= end:
+            return None
+
+        first, last = offset // BLOCK_SIZE, (end - 1) // BLOCK_SIZE
+
+        if not self._has_blocks(first, last):
+            return None
+
+        start = first * BLOCK_SIZE
+
+        with open(self._data_path, 'rb') as f, \
+                mmap.mmap(f.fileno(), end - start, access=mmap.ACCESS_READ, offset=start) as m:
+            return m[offset - start:end - start]
+
+    def put(self, offset: int, data: bytes):
+        """
+        Stores the complete blocks of data. offset has to be aligned to a block.
+        Nothing is stored if another process is writing the document at the moment
+        """
+        if offset % BLOCK_SIZE != 0 or self.size == 0:
+            return
+
+        map_fd = os.open(self._map_path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        try:
+            # don't hold an executor thread waiting for another process
+            fcntl.flock(map_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.debug("%s is locked by another process" % self._map_path)
+            os.close(map_fd)
+            return
+
+        try:
+            data_fd = os.open(self._data_path, os.O_RDWR | os.O_CREAT, 0o644)
+
+            try:
+                # files only ever grow to their final size so readers never see them shrink
+                if os.fstat(data_fd).st_size < self.size:
+                    os.ftruncate(data_fd, self.size)
+
+                if os.fstat(map_fd).st_size < self.blocks:
+                    os.ftruncate(map_fd, self.blocks)
+
+                blocks = 0
+
+                for block_start in range(offset, offset + len(data), BLOCK_SIZE):
+                    block_len = min(BLOCK_SIZE, self.size - block_start)
+                    block_data = data[block_start - offset:block_start - offset + block_len]
+
+                    if block_len <= 0 or len(block_data) < block_len:
+                        break
+
+                    os.pwrite(data_fd, block_data, block_start)
+                    blocks += 1
+
+                if blocks:
+                    # the data has to reach the disk before the marks do, otherwise after a crash
+                    # a zero filled block could be marked complete
+                    os.fdatasync(data_fd)
+                    os.pwrite(map_fd, b'\x01' * blocks, offset // BLOCK_SIZE)
+            finally:
+                os.close(data_fd)
+        except OSError as e:
+            logger.warning("Cannot write %s: %s" % (self._data_path, e))
+        finally:
+            os.close(map_fd)
+
+
+class SharedBlockCache:
+    """
+    Documents' blocks stored in a directory that can be shared by several tgmount processes.
+    Documents are keyed by document_id which is the same for every account
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+        os.makedirs(path, exist_ok=True)
+
+    def document(self, document_id: str, size: int) -> CachedDocument:
+        return CachedDocument(self.path, document_id, size)
@@ -1,9 +1,14 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Callable, Any, Optional
+from typing import Callable, Any, Optional, Dict, TYPE_CHECKING
 
-import pyfuse3
+from telethon.hints import Entity
 from telethon.tl.custom import Message
+from telethon.utils import get_peer_id
+
+if TYPE_CHECKING:
+    # pyfuse3 is only needed by mount
+    import pyfuse3
 
 
 
@@ -31,13 +36,43 @@ class TgfsFile:
     msg: Message
     handle: DocumentHandle
     inode: Optional[int]
-    attr: Optional[pyfuse3.EntryAttributes]
+    attr: Optional['pyfuse3.EntryAttributes']
+    parent: int
+    header: bytes = bytes()
 
     @property
     def fname(self):
         return message_doc_filename_format(self.msg, self.handle.document)
 
 
+@dataclass
+class TgfsDirectory:
+    inode: int
+    name: bytes
+    parent: int
+    attr: 'pyfuse3.EntryAttributes'
+    # child name -> child inode, in the order of insertion
+    children: Dict[bytes, int] = field(default_factory=dict)
+    # directories created by layout are removed once they become empty
+    auto_remove: bool = False
+
+
+@dataclass
+class MountedChat:
+    entity: Entity
+    # inode of the directory the chat's files are placed into
+    inode: int
+    # the newest message id seen in the chat, missed updates are fetched starting from it
+    last_message_id: int = 0
+
+    @property
+    def chat_id(self):
+        """
+        Marked peer id, the same as Message.chat_id of the chat's messages
+        """
+        return get_peer_id(self.entity)
+
+
 def message_doc_filename_format(msg: Message, doc: TgmountDocument):
     attr_file_name = doc.attributes.get('file_name')
 
@@ -0,0 +1,61 @@
+import struct
+from typing import Optional
+
+from tgmount.dclasses import TgmountDocument
+
+ID3_MIME_TYPES = ('audio/mpeg',)
+
+
+def syncsafe(value: int) -> bytes:
+    """
+    Encodes integer as 4 bytes with the most significant bit of each byte zeroed
+    """
+    return bytes([
+        (value >> 21) & 0x7f,
+        (value >> 14) & 0x7f,
+        (value >> 7) & 0x7f,
+        value & 0x7f,
+    ])
+
+
+def text_frame(frame_id: str, text: str) -> bytes:
+    # encoding 0x01 is UTF-16 with BOM, the most compatible choice for ID3v2.3
+    data = b'\x01' + text.encode('utf-16')
+    return frame_id.encode() + struct.pack('>IH', len(data), 0) + data
+
+
+def id3v2_tag(title: Optional[str] = None,
+              performer: Optional[str] = None,
+              duration: Optional[int] = None) -> bytes:
+    """
+    Returns ID3v2.3 tag with TIT2, TPE1 and TLEN frames or empty bytes if there is nothing to put into it
+    """
+    frames = bytes()
+
+    if title:
+        frames += text_frame('TIT2', title)
+
+    if performer:
+        frames += text_frame('TPE1', performer)
+
+    if duration:
+        data = b'\x00' + str(duration * 1000).encode()
+        frames += b'TLEN' + struct.pack('>IH', len(data), 0) + data
+
+    if not frames:
+        return bytes()
+
+    return b'ID3' + bytes([3, 0, 0]) + syncsafe(len(frames)) + frames
+
+
+def document_id3_tag(doc: TgmountDocument) -> bytes:
+    """
+    Synthesizes ID3v2 tag from the document's DocumentAttributeAudio so players
+    don't need to fetch the real header from telegram
+    """
+    if doc.mime_type not in ID3_MIME_TYPES:
+        return bytes()
+
+    return id3v2_tag(title=doc.attributes.get('title'),
+                     performer=doc.attributes.get('performer'),
+                     duration=doc.attributes.get('duration'))
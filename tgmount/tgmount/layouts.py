@@ -0,0 +1,53 @@
+from typing import Callable, Dict, List, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # keeps the module importable by the command line parser without telethon
+    from tgmount.dclasses import TgmountDocument
+
+Layout = Callable[['TgmountDocument'], List[bytes]]
+
+UNKNOWN = b'Unknown'
+
+
+def path_component(value: Optional[str]) -> bytes:
+    """
+    Turns arbitrary string into a valid directory name
+    """
+    if not value:
+        return UNKNOWN
+
+    name = value.replace('/', '_').replace('\0', '').strip()
+
+    if name in ('', '.', '..'):
+        return UNKNOWN
+
+    return name.encode()
+
+
+def layout_flat(doc: 'TgmountDocument') -> List[bytes]:
+    return []
+
+
+def layout_performer(doc: 'TgmountDocument') -> List[bytes]:
+    return [path_component(doc.attributes.get('performer'))]
+
+
+def layout_date(doc: 'TgmountDocument') -> List[bytes]:
+    date = doc.message_date or doc.document_date
+
+    if not date:
+        return [UNKNOWN]
+
+    return [("%04d" % date.year).encode(), ("%02d" % date.month).encode()]
+
+
+def layout_mime(doc: 'TgmountDocument') -> List[bytes]:
+    return [path_component(part) for part in (doc.mime_type or '').split('/', 1)]
+
+
+LAYOUTS: Dict[str, Layout] = {
+    'flat': layout_flat,
+    'performer': layout_performer,
+    'date': layout_date,
+    'mime': layout_mime,
+}
@@ -0,0 +1,131 @@
+import re
+from bisect import bisect_left, insort
+from typing import Dict, List, Optional, Set, Tuple
+
+from tgmount.dclasses import TgmountDocument
+
+FIELDS = ('name', 'title', 'performer', 'mime', 'date')
+
+TOKEN_RE = re.compile(r'\w+')
+DURATION_RE = re.compile(r'duration([<>])(\d+)')
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    if not text:
+        return []
+
+    return TOKEN_RE.findall(text.lower())
+
+
+def document_fields(doc: TgmountDocument) -> Dict[str, List[str]]:
+    date = doc.message_date or doc.document_date
+
+    return {
+        'name': tokenize(doc.attributes.get('file_name')),
+        'title': tokenize(doc.attributes.get('title')),
+        'performer': tokenize(doc.attributes.get('performer')),
+        # mime and date are matched as a whole so date:2020-05 finds everything posted in May 2020
+        'mime': [doc.mime_type.lower()] if doc.mime_type else [],
+        'date': [date.strftime('%Y-%m-%d')] if date else [],
+    }
+
+
+class SearchIndex:
+    """
+    Inverted index over documents' attributes. Query is a list of terms all of which have to match:
+
+    word            any field has a word starting with it
+    field:word      the field has a word starting with it. Fields: name, title, performer, mime, date
+    duration>N      longer than N seconds, duration<N is shorter than N seconds
+    """
+
+    def __init__(self):
+        # 'field:token' -> inodes
+        self._postings: Dict[str, Set[int]] = {}
+        # sorted keys of _postings for prefix lookups
+        self._keys: List[str] = []
+        # inode -> (keys, duration)
+        self._documents: Dict[int, Tuple[Set[str], Optional[int]]] = {}
+
+    def add(self, inode: int, doc: TgmountDocument):
+        keys = set("%s:%s" % (field, token)
+                   for field, tokens in document_fields(doc).items()
+                   for token in tokens)
+
+        for key in keys:
+            if key not in self._postings:
+                self._postings[key] = set()
+                insort(self._keys, key)
+
+            self._postings[key].add(inode)
+
+        self._documents[inode] = (keys, doc.attributes.get('duration'))
+
+    def remove(self, inode: int):
+        keys, _ = self._documents.pop(inode, (set(), None))
+
+        for key in keys:
+            inodes = self._postings[key]
+            inodes.discard(inode)
+
+            if not inodes:
+                del self._postings[key]
+                del self._keys[bisect_left(self._keys, key)]
+
+    def _prefix(self, field: str, prefix: str) -> Set[int]:
+        start = "%s:%s" % (field, prefix)
+        result = set()
+
+        for idx in range(bisect_left(self._keys, start), len(self._keys)):
+            key = self._keys[idx]
+
+            if not key.startswith(start):
+                break
+
+            result |= self._postings[key]
+
+        return result
+
+    def _term(self, term: str) -> List[Set[int]]:
+        field, sep, value = term.partition(':')
+
+        if sep and field in FIELDS:
+            values = [value.lower()] if field in ('mime', 'date') else tokenize(value)
+            return [self._prefix(field, v) for v in values]
+
+        return [set().union(*(self._prefix(f, token) for f in FIELDS))
+                for token in tokenize(term)]
+
+    def search(self, query: str) -> Set[int]:
+        matches: List[Set[int]] = []
+        durations = []
+
+        for term in query.split():
+            duration = DURATION_RE.fullmatch(term.lower())
+
+            if duration:
+                durations.append((duration.group(1), int(duration.group(2))))
+            else:
+                matches.extend(self._term(term))
+
+        if matches:
+            matches.sort(key=len)
+            result = matches[0].intersection(*matches[1:])
+        elif durations:
+            result = set(self._documents.keys())
+        else:
+            return set()
+
+        for op, seconds in durations:
+            result = set(inode for inode in result
+                         if self._matches_duration(inode, op, seconds))
+
+        return result
+
+    def _matches_duration(self, inode: int, op: str, seconds: int):
+        duration = self._documents[inode][1]
+
+        if duration is None:
+            return False
+
+        return duration > seconds if op == '>' else duration < seconds
@@ -1,36 +1,34 @@
+import asyncio
 import getpass
 import logging
+from collections import OrderedDict
 from random import random
-from typing import Dict, Optional, List, Tuple
+from typing import AsyncIterator, Awaitable, Callable, Optional, List, Tuple, TYPE_CHECKING
 
 from telethon import TelegramClient
 from telethon.errors import SessionPasswordNeededError, FileReferenceExpiredError
+from telethon.hints import Entity
 from telethon.tl.custom import Message
 from telethon.tl.types import (DocumentAttributeAudio,
                                DocumentAttributeFilename,
                                InputDocumentFileLocation,
                                InputMessagesFilterMusic)
-from telethon.utils import get_display_name
 
 from tgmount.dclasses import TgmountDocument, DocumentHandle
 
+if TYPE_CHECKING:
+    from tgmount.cache import CachedDocument, SharedBlockCache
+
 logger = logging.getLogger('tgclient')
 
-MB = 1048576
 KB = 1024
 BLOCK_SIZE = 128 * KB
 
-
-def block(byte_idx: int):
-    return byte_idx // BLOCK_SIZE
-
-
-def block_mb(block_idx: int):
-    return (block_idx * BLOCK_SIZE) // MB
-
-
-def mb(byte: int):
-    return byte // MB
+MIN_REQUEST_SIZE = 4 * KB
+# upload.getFile accepts up to 1MB but telethon's iter_download caps request_size at 512KB
+MAX_REQUEST_SIZE = 512 * KB
+# number of documents keeping their last fetched range, up to MAX_REQUEST_SIZE each
+READ_AHEAD_BUFFERS = 16
 
 
 def split_range(offset: int, limit: int, block_size=BLOCK_SIZE):
@@ -41,18 +39,11 @@ def split_range(offset: int, limit: int, block_size=BLOCK_SIZE):
     10485760 (1MB) must be divisible by limit
     offset / (1024 * 1024) == (offset + limit - 1) / (1024 * 1024)
     (file parts that are being downloaded must always be inside the same megabyte-sized fragment)
-    """
-    if offset % 4096 != 0:
-        offset = (offset // 4096) * 4096
-
-    if limit % 4096 != 0:
-        limit = (limit // 4096 + 1) * 4096
-
-    a = offset
-    b = offset + limit
 
-    starting_block = block(a)
-    ending_block = block(b - 1)
+    block_size must be a power of two between 4096 bytes and 1MB so the ranges aligned to it satisfy them
+    """
+    starting_block = offset // block_size
+    ending_block = (offset + max(limit, 1) - 1) // block_size
 
     blocks = list(range(starting_block, ending_block + 1))
 
@@ -62,6 +53,122 @@ def split_range(offset: int, limit: int, block_size=BLOCK_SIZE):
     return rngs
 
 
+def request_size_for(limit: int, min_request_size=MIN_REQUEST_SIZE):
+    """
+    Returns the smallest request size covering limit bytes
+    """
+    request_size = min_request_size
+
+    while request_size < min(limit, MAX_REQUEST_SIZE):
+        request_size *= 2
+
+    return request_size
+
+
+class ReadAheadBuffers:
+    """
+    The last fetched ranges of the most recently read documents. Older ones are dropped so memory
+    use doesn't grow with the number of documents read during the mount's lifetime
+    """
+
+    def __init__(self, capacity=READ_AHEAD_BUFFERS):
+        self.capacity = capacity
+        self._buffers: 'OrderedDict[str, Tuple[int, bytes]]' = OrderedDict()
+
+    def get(self, key: str) -> Tuple[int, bytes]:
+        buffer = self._buffers.get(key)
+
+        if buffer is None:
+            return 0, bytes()
+
+        self._buffers.move_to_end(key)
+
+        return buffer
+
+    def put(self, key: str, offset: int, data: bytes):
+        self._buffers[key] = (offset, data)
+        self._buffers.move_to_end(key)
+
+        while len(self._buffers) > self.capacity:
+            self._buffers.popitem(last=False)
+
+
+class AdaptiveReader:
+    """
+    Reads a document choosing request size by the access pattern. Random reads request as little
+    as possible, sequential reads double the request size up to MAX_REQUEST_SIZE. The last fetched
+    range is kept in buffers under key to serve the following reads.
+
+    With a cache the requests are at least BLOCK_SIZE long so every fetched block can be stored.
+    The cache is read and written in the default executor so disk I/O doesn't stall the other
+    requests served by the loop
+    """
+
+    def __init__(self, size: int, fetch: Callable[[int, int, int], Awaitable[Tuple[int, bytes]]],
+                 buffers: ReadAheadBuffers, key: str, cache: Optional['CachedDocument'] = None):
+        self.size = size
+        self.min_request_size = BLOCK_SIZE if cache is not None else MIN_REQUEST_SIZE
+        self.request_size = self.min_request_size
+
+        self._fetch = fetch
+        self._buffers = buffers
+        self._key = key
+        self._cache = cache
+        self._next_offset = None
+
+    async def read(self, offset: int, limit: int) -> bytes:
+        end = min(offset + limit, self.size)
+
+        if offset >= end:
+            return bytes()
+
+        sequential = offset == self._next_offset
+        self._next_offset = end
+
+        chunk = bytes()
+        buffer_offset, buffer = self._buffers.get(self._key)
+
+        if buffer_offset <= offset < buffer_offset + len(buffer):
+            chunk = buffer[offset - buffer_offset: end - buffer_offset]
+
+            if offset + len(chunk) == end:
+                return chunk
+
+            offset += len(chunk)
+
+        loop = asyncio.get_running_loop()
+
+        if self._cache is not None:
+            cached = await loop.run_in_executor(None, self._cache.get, offset, end - offset)
+
+            if cached is not None:
+                return chunk + cached
+
+        request_size = request_size_for(end - offset, self.min_request_size)
+
+        if sequential or chunk:
+            self.request_size = min(MAX_REQUEST_SIZE, max(self.request_size * 2, request_size))
+
+            # prefer requests starting right where the fetched data ends to refetching it
+            while self.request_size > request_size and offset % self.request_size:
+                self.request_size //= 2
+        else:
+            self.request_size = request_size
+
+        logger.debug("read(offset=%d, limit=%d): request_size=%d, sequential=%s"
+                     % (offset, end - offset, self.request_size, sequential))
+
+        start, data = await self._fetch(offset, end - offset, self.request_size)
+
+        self._buffers.put(self._key, start, data)
+
+        if self._cache is not None:
+            # the data is returned without waiting for it to be written
+            loop.run_in_executor(None, self._cache.put, start, data)
+
+        return chunk + data[offset - start: end - start]
+
+
 def msg_to_inputlocation(msg: Message) -> InputDocumentFileLocation:
     return InputDocumentFileLocation(id=msg.media.document.id,
                                      access_hash=msg.media.document.access_hash,
@@ -69,6 +176,19 @@ def msg_to_inputlocation(msg: Message) -> InputDocumentFileLocation:
                                      thumb_size='')
 
 
+def is_music(msg: Message) -> bool:
+    """
+    Client side counterpart of InputMessagesFilterMusic
+    """
+    document = getattr(getattr(msg, 'media', None), 'document', None)
+
+    if not document:
+        return False
+
+    return any(isinstance(attr, DocumentAttributeAudio) and not attr.voice
+               for attr in document.attributes)
+
+
 def document_from_message(msg: Message) -> Optional[TgmountDocument]:
     if not getattr(msg, 'media', None):
         return None
@@ -119,6 +239,31 @@ class TelegramFsClient(TelegramClient):
         self.api_id = api_id
         self.api_hash = api_hash
 
+        # SharedBlockCache used by the reading functions
+        self.block_cache: Optional['SharedBlockCache'] = None
+        # shared by the reading functions of all the documents
+        self._read_buffers = ReadAheadBuffers()
+
+        self._reconnect_handlers: List[Callable[[], Awaitable]] = []
+
+    def add_reconnect_handler(self, callback: Callable[[], Awaitable]):
+        """
+        callback is awaited every time the connection is restored after being lost
+        """
+        self._reconnect_handlers.append(callback)
+
+    async def _handle_auto_reconnect(self):
+        # telethon doesn't catch up with the updates missed while disconnected
+        await super()._handle_auto_reconnect()
+
+        logger.debug('Reconnected')
+
+        for callback in self._reconnect_handlers:
+            try:
+                await callback()
+            except Exception:
+                logger.exception('Reconnect handler %s failed' % callback)
+
     async def auth(self):
         logger.debug('Connecting to Telegram servers...')
 
@@ -151,20 +296,32 @@ class TelegramFsClient(TelegramClient):
 
                     self_user = await self.sign_in(password=pw)
 
-    async def get_dialogs_dict(self, limit=150, offset_id=0) -> Dict:
+    async def resolve_entity(self, id) -> Entity:
         """
-        Returns mapping dialog_display_name -> dialog
+        Resolves chat by username or numeric ID. Numeric IDs are looked up in the entities
+        cached by the session file first. Dialogs are only fetched on a cache miss and only
+        until the chat is found
         """
-        logger.debug("get_dialogs_map(limit=%s, offset_id=%d)" %
-                     (limit, offset_id))
+        try:
+            return await self.get_entity(id)
+        except ValueError:
+            if not isinstance(id, int):
+                raise
 
-        dialogs = await self.get_dialogs(limit=limit, offset_id=offset_id)
+        logger.debug("%d is not cached. Searching dialogs" % id)
 
-        entities = [(get_display_name(d.entity), d.entity) for d in dialogs]
+        async for dialog in self.iter_dialogs():
+            if id in (dialog.id, dialog.entity.id):
+                # entities received with the dialogs are persisted for the next run
+                self.session.save()
+                return dialog.entity
 
-        return dict(entities)
+        raise ValueError("Cannot find chat %d in the dialogs" % id)
 
-    async def get_file_chunk(self, input_location, offset, limit, *, request_size=BLOCK_SIZE):
+    async def get_file_blocks(self, input_location, offset, limit, *, request_size=BLOCK_SIZE) -> Tuple[int, bytes]:
+        """
+        Returns the data of request_size aligned blocks covering the range along with the offset of the first one
+        """
         ranges = split_range(offset, limit, request_size)
         result = bytes()
         #
@@ -177,13 +334,14 @@ class TelegramFsClient(TelegramClient):
                                               limit=len(ranges) - 1):
             result += chunk
 
-        return result[offset - ranges[0]: offset - ranges[0] + limit]
+        return ranges[0], result
 
     def get_reading_function(self, msg: Message, input_location: InputDocumentFileLocation):
+        chat_id = msg.chat_id
 
-        async def _inner(offset, limit, *, request_size=BLOCK_SIZE, chat_id=msg.chat_id):
+        async def _fetch(offset, limit, request_size):
             try:
-                chunk = await self.get_file_chunk(input_location, offset, limit, request_size=request_size)
+                return await self.get_file_blocks(input_location, offset, limit, request_size=request_size)
             except FileReferenceExpiredError:
                 logger.debug(f'FileReferenceExpiredError was caught. file_reference for msg={msg.id} from {chat_id} needs refetching')
                 refetched_msg = await self.get_messages(chat_id, ids=msg.id)
@@ -201,11 +359,12 @@ class TelegramFsClient(TelegramClient):
 
                 logger.debug(f'new file_reference={str(input_location.file_reference)}')
 
-                chunk = await self.get_file_chunk(input_location, offset, limit, request_size=request_size)
+                return await self.get_file_blocks(input_location, offset, limit, request_size=request_size)
 
-            return chunk
+        document = msg.media.document
+        cache = self.block_cache.document(str(document.id), document.size) if self.block_cache else None
 
-        return _inner
+        return AdaptiveReader(document.size, _fetch, self._read_buffers, str(document.id), cache).read
 
     def get_document_handle(self, msg):
         document = document_from_message(msg)
@@ -217,63 +376,68 @@ class TelegramFsClient(TelegramClient):
 
         return DocumentHandle(document=document, read_func=read_func)
 
-    async def _get_documents_handles(self, entity, limit=None, offset_id=0, reverse=False, filter_music=False,
-                                     ids=None):
+    async def iter_documents(self, entity, limit=None, offset_id=0, reverse=False, filter_music=False,
+                             min_id=0) -> AsyncIterator[Tuple[Message, DocumentHandle]]:
         """
-        Returns two lists: list of processed messages and list of tuples (message, document)
+        Yields tuples (message, document) as messages are being received. limit is the number of documents
         """
-        handles = []
+        logger.debug("iter_documents(entity=%s, limit=%s, offset_id=%s, reverse=%s, filter_music=%s, min_id=%s)"
+                     % (entity.id, limit, offset_id, reverse, filter_music, min_id))
 
-        messages = await self.get_messages(entity, limit=limit, offset_id=offset_id, reverse=reverse,
-                                           filter=InputMessagesFilterMusic if filter_music else None, ids=ids)
+        count = 0
 
-        messages_with_documents = []
-        logger.debug("Received %d messages" % len(messages))
+        if limit is not None and limit <= 0:
+            return
 
-        for msg in messages:
+        # with the filter every message has a document so the server can apply the limit
+        async for msg in self.iter_messages(entity,
+                                            limit=limit if filter_music else None,
+                                            offset_id=offset_id,
+                                            reverse=reverse,
+                                            filter=InputMessagesFilterMusic if filter_music else None,
+                                            min_id=min_id):
             document = self.get_document_handle(msg)
-            if document:
-                messages_with_documents.append(msg)
-                handles.append(document)
-
-        return messages_with_documents, handles
-
-    async def get_documents(self, entity, limit=None, offset_id=0, reverse=False, filter_music=False, ids=None) -> \
-            Tuple[List[Message], List[DocumentHandle]]:
-        """
-        Returns list of tuples (message, document)
-        """
-
-        logger.debug("get_documents(entity=%s, limit=%s, offset_id=%s, reverse=%s, filter_music=%s, ids=%s)"
-                     % (entity.id, limit, offset_id, reverse, filter_music, ids))
 
-        messages, documents_handles = \
-            await self._get_documents_handles(entity,
-                                              limit=limit,
-                                              offset_id=offset_id,
-                                              reverse=reverse,
-                                              filter_music=filter_music,
-                                              ids=ids)
-
-        logger.debug("Received %d documents" % len(documents_handles))
+            if not document:
+                continue
 
-        while not ids and limit and limit > len(documents_handles):
+            yield msg, document
 
-            logger.debug("Loading more documents")
+            count += 1
 
-            more_messages, more_documents_handles = \
-                await self._get_documents_handles(entity,
-                                                  offset_id=messages[-1].id,
-                                                  limit=100,
-                                                  reverse=reverse,
-                                                  filter_music=filter_music)
+            if limit is not None and count >= limit:
+                break
 
-            logger.debug("Received %d documents" % len(more_documents_handles))
+    async def get_documents(self, entity, limit=None, offset_id=0, reverse=False, filter_music=False, ids=None,
+                            min_id=0) -> Tuple[List[Message], List[DocumentHandle]]:
+        """
+        Returns list of messages and list of their documents. With min_id only messages newer than min_id
+        are retrieved
+        """
 
-            if len(messages) == 0:
-                break
+        logger.debug("get_documents(entity=%s, limit=%s, offset_id=%s, reverse=%s, filter_music=%s, ids=%s, "
+                     "min_id=%s)" % (entity.id, limit, offset_id, reverse, filter_music, ids, min_id))
+
+        messages = []
+        documents_handles = []
+
+        if ids:
+            for msg in await self.get_messages(entity, ids=ids):
+                document = self.get_document_handle(msg)
+
+                if document:
+                    messages.append(msg)
+                    documents_handles.append(document)
+        else:
+            async for msg, document in self.iter_documents(entity,
+                                                           limit=limit,
+                                                           offset_id=offset_id,
+                                                           reverse=reverse,
+                                                           filter_music=filter_music,
+                                                           min_id=min_id):
+                messages.append(msg)
+                documents_handles.append(document)
 
-            documents_handles.extend(more_documents_handles)
-            messages.extend(more_messages)
+        logger.debug("Received %d documents" % len(documents_handles))
 
-        return messages[:limit], documents_handles[:limit]
+        return messages, documents_handles
@@ -3,16 +3,24 @@ import logging
 import os
 import stat
 import traceback
-from typing import Dict
+from collections import Counter
+from itertools import islice
+from typing import Dict, List, Optional, Tuple
 
 import pyfuse3
-from funcy import *
 
-from tgmount.dclasses import TgmountDocument, DocumentHandle, TgfsFile
+from tgmount.dclasses import TgmountDocument, DocumentHandle, TgfsFile, TgfsDirectory
+from tgmount.id3 import document_id3_tag
+from tgmount.layouts import Layout, layout_flat
+from tgmount.search import SearchIndex
 from telethon.tl.custom import Message
 
 logvfs = logging.getLogger('tgvfs')
 
+SEARCH_DIR = b'.search'
+# number of queries kept in /.search
+SEARCH_HISTORY = 100
+
 
 def create_attributes(
         inode: int,
@@ -40,10 +48,10 @@ def create_attributes(
     return attrs
 
 
-def create_attributes_from_doc(doc: TgmountDocument, inode: int):
+def create_attributes_from_doc(doc: TgmountDocument, inode: int, header_size: int = 0):
     attrs = create_attributes(
         inode=inode,
-        size=doc.size,
+        size=doc.size + header_size,
         stamp=int(doc.message_date.timestamp() * 1e9) if doc.message_date else int(1438467123.985654 * 1e9),
         directory=False
     )
@@ -80,75 +88,250 @@ def exception_handler(func):
 
 
 class TelegramFsAsync(pyfuse3.Operations):
-    def __init__(self):
+    def __init__(self, id3_tags=False, layout: Layout = layout_flat, search=False):
         super(TelegramFsAsync, self).__init__()
 
+        self._id3_tags = id3_tags
+        self._layout = layout
+
         self._files: Dict[int, TgfsFile] = {}
-        self._file_by_name = {}
+        # (chat_id, message_id) -> inode
+        self._file_by_message: Dict[Tuple[int, int], int] = {}
+        self._dirs: Dict[int, TgfsDirectory] = {
+            pyfuse3.ROOT_INODE: TgfsDirectory(pyfuse3.ROOT_INODE, b'', pyfuse3.ROOT_INODE, root_attr())
+        }
 
-        self._inodes = []
         self._last_inode = pyfuse3.ROOT_INODE
 
-    def update_index(self):
-        self._file_by_name = walk_keys(
-            lambda inode: self._files[inode].fname, self._files)
+        # inode -> number of handles, directories being listed aren't evicted from /.search
+        self._open_dirs: Dict[int, int] = {}
+
+        self._search_index: Optional[SearchIndex] = None
+        self._search_inode = None
+
+        if search:
+            self._search_index = SearchIndex()
+            self._search_inode = self._mkdir(pyfuse3.ROOT_INODE, SEARCH_DIR).inode
+
+    def _next_inode(self):
+        self._last_inode += 1
+        return self._last_inode
+
+    def _mkdir(self, parent_inode: int, name: bytes, auto_remove=False) -> TgfsDirectory:
+        if self._search_inode is not None and parent_inode == pyfuse3.ROOT_INODE and name == SEARCH_DIR:
+            # chats and performers named .search can't take the place of the search directory
+            name = b'_' + name
+
+        parent = self._dirs[parent_inode]
+        inode = parent.children.get(name)
+
+        if inode is not None:
+            if inode not in self._dirs:
+                raise ValueError("%s is not a directory" % name)
+            return self._dirs[inode]
+
+        inode = self._next_inode()
+        directory = TgfsDirectory(inode, name, parent_inode, create_attributes(inode), auto_remove=auto_remove)
+
+        self._dirs[inode] = directory
+        parent.children[name] = inode
+
+        return directory
+
+    def _layout_directory(self, doc: TgmountDocument, parent_inode: int) -> TgfsDirectory:
+        directory = self._dirs[parent_inode]
+
+        for name in self._layout(doc):
+            directory = self._mkdir(directory.inode, name, auto_remove=True)
+
+        return directory
+
+    def mkdir(self, name: bytes, parent_inode: int = pyfuse3.ROOT_INODE) -> int:
+        return self._mkdir(parent_inode, name).inode
+
+    def add_file(self, msg: Message, doc: DocumentHandle, parent_inode: int = pyfuse3.ROOT_INODE):
+        key = (doc.document.chat_id, msg.id)
 
-        self._inodes = list(self._files.keys())
+        if key in self._file_by_message:
+            logvfs.debug("add_file: message %s from %s is already mounted" % (msg.id, doc.document.chat_id))
+            return
 
-    def add_file(self, msg: Message, doc: DocumentHandle):
-        self._add_file(msg, doc)
-        self.update_index()
+        inode = self._next_inode()
 
-    def _add_file(self, msg: Message, doc: DocumentHandle):
-        inode = self._last_inode + 1
+        header = document_id3_tag(doc.document) if self._id3_tags else bytes()
 
-        attrs = create_attributes_from_doc(doc.document, inode)
-        new_file = TgfsFile(msg, doc, inode, attrs)
+        attrs = create_attributes_from_doc(doc.document, inode, len(header))
+        directory = self._layout_directory(doc.document, parent_inode)
+
+        new_file = TgfsFile(msg, doc, inode, attrs, directory.inode, header)
 
         self._files[inode] = new_file
-        self._last_inode = inode
+        self._file_by_message[key] = inode
+        directory.children[new_file.fname] = inode
 
-    @exception_handler
-    async def getattr(self, inode: int, ctx=None):
-        if inode == pyfuse3.ROOT_INODE:
-            return root_attr()
+        if self._search_index is not None:
+            self._search_index.add(inode, doc.document)
+
+    def add_files(self, messages: List[Message], docs: List[DocumentHandle],
+                  parent_inode: int = pyfuse3.ROOT_INODE):
+        for msg, doc in zip(messages, docs):
+            self.add_file(msg, doc, parent_inode)
+
+    def remove_file(self, chat_id: int, message_id: int) -> Optional[TgfsFile]:
+        """
+        Removes file posted in message_id from chat_id and invalidates kernel's cache entry
+        """
+        inode = self._file_by_message.pop((chat_id, message_id), None)
+
+        if inode is None:
+            return None
+
+        file = self._files.pop(inode)
+        directory = self._dirs[file.parent]
+
+        directory.children.pop(file.fname, None)
+        pyfuse3.invalidate_entry_async(directory.inode, file.fname, deleted=inode, ignore_enoent=True)
+
+        if self._search_index is not None:
+            self._search_index.remove(inode)
+            self._remove_search_results(file)
+
+        # layout directories don't outlive their last file
+        while directory.auto_remove and not directory.children:
+            parent = self._dirs[directory.parent]
+
+            del parent.children[directory.name]
+            del self._dirs[directory.inode]
+
+            pyfuse3.invalidate_entry_async(parent.inode, directory.name, deleted=directory.inode,
+                                           ignore_enoent=True)
+            directory = parent
+
+        return file
+
+    def _search_directory(self, query: bytes) -> TgfsDirectory:
+        """
+        Returns /.search/<query> directory filled with the current results of the query
+        """
+        search = self._dirs[self._search_inode]
+
+        if query not in search.children and len(search.children) >= SEARCH_HISTORY:
+            # forget the oldest query that isn't being listed
+            closed = [(name, inode) for name, inode in search.children.items()
+                      if not self._open_dirs.get(inode)]
+
+            if closed:
+                name, inode = closed[0]
+
+                del search.children[name]
+                del self._dirs[inode]
+
+                pyfuse3.invalidate_entry_async(search.inode, name, deleted=inode, ignore_enoent=True)
+
+        directory = self._mkdir(search.inode, query)
+        files = [self._files[inode] for inode in sorted(self._search_index.search(query.decode(errors='replace')))]
+
+        # files from different chats may have the same names
+        names = Counter(file.fname for file in files)
+
+        directory.children = {
+            (file.fname if names[file.fname] == 1 else b'%d %s' % (file.handle.document.chat_id, file.fname)): file.inode
+            for file in files
+        }
+
+        return directory
+
+    def _remove_search_results(self, file: TgfsFile):
+        for inode in self._dirs[self._search_inode].children.values():
+            results = self._dirs[inode].children
+
+            for name in [name for name, result in results.items() if result == file.inode]:
+                del results[name]
+
+    def update_file(self, msg: Message, doc: Optional[DocumentHandle], parent_inode: int = pyfuse3.ROOT_INODE):
+        """
+        Applies an edited message. The file is refreshed in place if the message keeps its document,
+        otherwise it's removed or replaced by the new document. Edits of messages that aren't mounted
+        are ignored
+        """
+        inode = self._file_by_message.get((msg.chat_id, msg.id))
+        file = self._files.get(inode)
+
+        if file is None:
+            return
+
+        if doc and file.handle.document.document_id == doc.document.document_id:
+            # caption edits. Refreshing the handle keeps file_reference up to date
+            file.msg = msg
+            file.handle = doc
+            return
+
+        self.remove_file(msg.chat_id, msg.id)
+
+        if doc:
+            self.add_file(msg, doc, parent_inode)
+
+    def _entry_attr(self, inode: int):
+        if inode in self._dirs:
+            return self._dirs[inode].attr
         elif inode in self._files:
             return self._files[inode].attr
         else:
             raise pyfuse3.FUSEError(errno.ENOENT)
 
+    @exception_handler
+    async def getattr(self, inode: int, ctx=None):
+        return self._entry_attr(inode)
+
     @exception_handler
     async def lookup(self, parent_inode: int, name: str, ctx=None):
         logvfs.debug("lookup(%s,%s)" % (parent_inode, name))
 
-        if parent_inode != pyfuse3.ROOT_INODE or name not in self._file_by_name:
+        if parent_inode == self._search_inode:
+            return self._search_directory(name).attr
+
+        directory = self._dirs.get(parent_inode)
+
+        if directory is None or name not in directory.children:
             raise pyfuse3.FUSEError(errno.ENOENT)
 
-        return self._file_by_name[name].attr
+        return self._entry_attr(directory.children[name])
 
     @exception_handler
     async def releasedir(self, fh):
         logvfs.debug("releasedir(%s)" % fh)
 
+        count = self._open_dirs.pop(fh, 0) - 1
+
+        if count > 0:
+            self._open_dirs[fh] = count
+
     @exception_handler
     async def opendir(self, inode, ctx):
         logvfs.debug("opendir(%s,%s)" % (inode, ctx))
-        if inode != pyfuse3.ROOT_INODE:
+        if inode not in self._dirs:
             raise pyfuse3.FUSEError(errno.ENOENT)
+
+        directory = self._dirs[inode]
+
+        if self._search_inode and directory.parent == self._search_inode:
+            # results are refreshed every time the directory is listed
+            self._search_directory(directory.name)
+
+        self._open_dirs[inode] = self._open_dirs.get(inode, 0) + 1
+
         return inode
 
     @exception_handler
     async def readdir(self, fh, off, token):
         logvfs.debug("readdir(%s,%s)" % (fh, off))
 
-        assert fh == pyfuse3.ROOT_INODE
-
-        inodes = self._inodes[off:]
+        directory = self._dirs[fh]
+        entries = islice(directory.children.items(), off, None)
 
-        for idx, inode in enumerate(inodes, off):
-            file = self._files[inode]
+        for idx, (name, inode) in enumerate(entries, off):
             if not pyfuse3.readdir_reply(
-                    token, file.fname, file.attr, idx + 1):
+                    token, name, self._entry_attr(inode), idx + 1):
                 break
 
     @exception_handler
@@ -170,8 +353,19 @@ class TelegramFsAsync(pyfuse3.Operations):
         logvfs.debug("read(fh=%s,off=%s,size=%s). totoal: %s; " %
                      (fh, off, size, off + size))
 
-        dh = self._files[fh].handle
-        chunk = await dh.read_func(off, size)
+        file = self._files[fh]
+        header = file.header
+        chunk = bytes()
+
+        # synthesized tag occupies the first len(header) bytes of the file
+        if off < len(header):
+            chunk = header[off:off + size]
+            size -= len(chunk)
+            off = len(header)
+
+        if size > 0:
+            chunk += await file.handle.read_func(off - len(header), size)
+
         logvfs.debug("readurned: %s" % len(chunk))
 
         return chunk
@@ -1,8 +1,6 @@
 import json
 from datetime import datetime
-from typing import List
-
-import socks
+from typing import AsyncIterable, Callable, List
 
 
 def none_or_int(value):
@@ -31,6 +29,29 @@ class DateTimeEncoder(json.JSONEncoder):
         return super().default(o)
 
 
+async def print_records(records: AsyncIterable[dict], output_format: str, tsv_format: Callable[[dict], str]):
+    """
+    Prints every record as soon as it's received. output_format is one of 'tsv', 'json' or 'ndjson'
+    """
+    first = True
+
+    if output_format == 'json':
+        print('[', end='', flush=True)
+
+    async for record in records:
+        if output_format == 'json':
+            print(('' if first else ', ') + json.dumps(record, cls=DateTimeEncoder), end='', flush=True)
+        elif output_format == 'ndjson':
+            print(json.dumps(record, cls=DateTimeEncoder), flush=True)
+        else:
+            print(tsv_format(record), flush=True)
+
+        first = False
+
+    if output_format == 'json':
+        print(']')
+
+
 def dict_exclude(d: dict, keys: List):
     return {
         k: v for k, v in d.items() if k not in keys
@@ -38,5 +59,7 @@ def dict_exclude(d: dict, keys: List):
 
 
 def proxy_arg(value):
+    import socks
+
     [proxy_host, proxy_port] = value.split(':')
     return (socks.SOCKS5, proxy_host, int(proxy_port))